@@ -36,6 +36,20 @@ def distribute(tree: Any) -> Any:
     return jax.device_put(tree, dist)
 
 
+def replicate(tree: Any) -> Any:
+    mesh = jax.sharding.Mesh(jax.devices(), 'i')
+    spec = jax.sharding.PartitionSpec()
+    repl = jax.sharding.NamedSharding(mesh, spec)
+
+    def put(x: Any) -> Any:
+        if isinstance(x, Array) and x.sharding.is_equivalent_to(repl, x.ndim):
+            return x
+        else:
+            return jax.device_put(x, repl)
+
+    return jax.tree_util.tree_map(put, tree)
+
+
 @inox.jit
 def ppca(x: Array, key: Array, rank: int = 1) -> Tuple[Array, DPLR]:
     r"""Fits :math:`(\mu_x, \Sigma_x)` by probabilistic principal component analysis (PPCA).
@@ -34,12 +34,20 @@ def to_pil(
     zoom: int = 1,
     file: Union[str, Path] = None,
 ) -> Image.Image:
-    x = np.asarray(x)
-    x = np.clip((x + 2) * (256 / 4), 0, 255)
-    x = np.rint(x).astype(np.uint8)
+    if isinstance(x, Array):  # quantize on device before transfer
+        x = jnp.clip((x + 2) * (256 / 4), 0, 255)
+        x = jnp.rint(x).astype(jnp.uint8)
+        x = np.asarray(x)
+    else:
+        x = np.clip((x + 2) * (256 / 4), 0, 255)
+        x = np.rint(x).astype(np.uint8)
+
     x = np.tile(x, (1, 1, 1, 1, 1))
     x = np.pad(x, pad_width=((0, 0), (0, 0), (pad, pad), (pad, pad), (0, 0)), constant_values=background)
-    x = rearrange(x, 'M N H W C -> (M H) (N W) C')
+
+    M, N, H, W, C = x.shape
+
+    x = x.transpose(0, 2, 1, 3, 4).reshape(M * H, N * W, C)
 
     if x.shape[-1] == 1:
         x = Image.fromarray(x.squeeze(-1), mode='L')
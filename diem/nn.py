@@ -2,9 +2,9 @@ r"""Neural networks"""
 
 import inox
 import inox.nn as nn
+import jax
 import jax.numpy as jnp
 
-from einops import rearrange
 from inox.random import PRNG, get_rng, set_rng
 from jax import Array
 from typing import *
@@ -53,6 +53,15 @@ class MLP(nn.Sequential):
         super().__init__(*layers)
 
 
+class LayerNorm(nn.LayerNorm):
+    r"""Creates a layer-normalization layer computed in (at least) single precision."""
+
+    def __call__(self, x: Array) -> Array:
+        dtype = jnp.promote_types(x.dtype, jnp.float32)
+
+        return super().__call__(x.astype(dtype)).astype(x.dtype)
+
+
 class Modulation(nn.Module):
     r"""Creates an adaptive modulation module."""
 
@@ -69,7 +78,10 @@ class Modulation(nn.Module):
 
     @inox.jit
     def __call__(self, t: Array) -> Tuple[Array, Array, Array]:
-        return jnp.array_split(self.mlp(t), 3, axis=-1)
+        m = self.mlp(t)
+        m = m.reshape(*m.shape[:-1], 3, -1)
+
+        return m[..., 0, :], m[..., 1, :], m[..., 2, :]
 
 
 class ResBlock(nn.Module):
@@ -80,15 +92,25 @@ class ResBlock(nn.Module):
         channels: int,
         emb_features: int,
         dropout: float = None,
+        separable: bool = False,
         **kwargs,
     ):
+        def conv() -> nn.Module:
+            if separable:  # depthwise + pointwise
+                return nn.Sequential(
+                    nn.Conv(channels, channels, groups=channels, **kwargs),
+                    nn.Linear(channels, channels),
+                )
+            else:
+                return nn.Conv(channels, channels, **kwargs)
+
         self.modulation = Modulation(channels, emb_features)
         self.block = nn.Sequential(
-            nn.LayerNorm(),
-            nn.Conv(channels, channels, **kwargs),
+            LayerNorm(),
+            conv(),
             nn.SiLU(),
             nn.Identity() if dropout is None else nn.TrainingDropout(dropout),
-            nn.Conv(channels, channels, **kwargs),
+            conv(),
         )
 
     def __call__(self, x: Array, t: Array) -> Array:
@@ -106,7 +128,7 @@ class AttBlock(nn.Module):
 
     def __init__(self, channels: int, emb_features: int, heads: int = 1):
         self.modulation = Modulation(channels, emb_features)
-        self.norm = nn.LayerNorm()
+        self.norm = LayerNorm()
         self.attn = nn.MultiheadAttention(
             heads=heads,
             in_features=channels,
@@ -114,13 +136,12 @@ class AttBlock(nn.Module):
             hid_features=channels // heads,
         )
 
-    @inox.checkpoint
     def __call__(self, x: Array, t: Array) -> Array:
         a, b, c = self.modulation(t)
 
         y = (a + 1) * x + b
         y = self.norm(y)
-        y = rearrange(y, '... H W C -> ... (H W) C')
+        y = y.reshape(*y.shape[:-3], -1, y.shape[-1])
         y = self.attn(y)
         y = y.reshape(x.shape)
         y = x + c * y
@@ -128,9 +149,84 @@ class AttBlock(nn.Module):
         return y / jnp.sqrt(1 + c**2)
 
 
+class Stack(nn.Module):
+    r"""Creates a stack of structurally identical blocks, applied with :func:`jax.lax.scan`.
+
+    The parameters of the blocks are stacked along a leading axis, such that the
+    traced graph does not grow with the number of blocks.
+
+    Arguments:
+        blocks: A sequence of blocks, each a list of time-conditional modules.
+        checkpoint: Whether the activations of the blocks are recomputed during the
+            backward pass or not.
+    """
+
+    def __init__(self, *blocks: List[nn.Module], checkpoint: bool = False):
+        def stack(*leaves: Any) -> Any:
+            if isinstance(leaves[0], Array):
+                return jnp.stack(leaves)
+            else:
+                return leaves[0]
+
+        self.blocks = jax.tree_util.tree_map(stack, *blocks)
+        self.length = len(blocks)
+        self.checkpoint = checkpoint
+
+    def __call__(self, x: Array, t: Array, key: Array = None) -> Array:
+        static, arrays = self.partition()
+
+        if key is None:
+            keys = None
+        else:
+            keys = jax.random.split(key, self.length)
+
+        def f(x, arrays_key):
+            arrays, key = arrays_key
+
+            with set_rng(None if key is None else PRNG(key)):
+                for block in static(arrays).blocks:
+                    x = block(x, t)
+
+            return x, None
+
+        if self.checkpoint:
+            f = jax.checkpoint(f)
+
+        x, _ = jax.lax.scan(f, x, (arrays, keys))
+
+        return x
+
+
+def restack(blocks: List[nn.Module]) -> List[nn.Module]:
+    r"""Groups the residual and attention blocks of a U-Net level into a :class:`Stack`.
+
+    U-Nets pickled before the introduction of :class:`Stack` store the blocks of
+    each level as a flat list.
+    """
+
+    head, units, tail = [], [], []
+
+    for block in blocks:
+        if isinstance(block, ResBlock):
+            units.append([block])
+        elif isinstance(block, AttBlock):
+            units[-1].append(block)
+        elif units:
+            tail.append(block)
+        else:
+            head.append(block)
+
+    if units:
+        return [*head, Stack(*units), *tail]
+    else:
+        return blocks
+
+
 class UNet(nn.Module):
     r"""Creates a time (or noise) conditional U-Net."""
 
+    dtype: str = None
+
     def __init__(
         self,
         in_channels: int,
@@ -141,11 +237,16 @@ class UNet(nn.Module):
         emb_features: int = 64,
         heads: Dict[int, int] = {},
         dropout: float = None,
+        separable: bool = False,
+        dtype: str = None,
+        checkpoint_levels: Sequence[int] = (),
         key: Array = None,
     ):
         if key is None:
             key = get_rng().split()
 
+        self.dtype = dtype
+
         stride = [2 for k in kernel_size]
         kwargs = dict(
             kernel_size=kernel_size,
@@ -159,12 +260,16 @@ class UNet(nn.Module):
                 do, up = [], []
 
                 for _ in range(blocks):
-                    do.append(ResBlock(hid_channels[i], emb_features, dropout=dropout, **kwargs))
-                    up.append(ResBlock(hid_channels[i], emb_features, dropout=dropout, **kwargs))
+                    do.append([ResBlock(hid_channels[i], emb_features, dropout=dropout, separable=separable, **kwargs)])
+                    up.append([ResBlock(hid_channels[i], emb_features, dropout=dropout, separable=separable, **kwargs)])
 
                     if i in heads:
-                        do.append(AttBlock(hid_channels[i], emb_features, heads[i]))
-                        up.append(AttBlock(hid_channels[i], emb_features, heads[i]))
+                        do[-1].append(AttBlock(hid_channels[i], emb_features, heads[i]))
+                        up[-1].append(AttBlock(hid_channels[i], emb_features, heads[i]))
+
+                if blocks > 0:
+                    do = [Stack(*do, checkpoint=i in checkpoint_levels)]
+                    up = [Stack(*up, checkpoint=i in checkpoint_levels)]
 
                 if i > 0:
                     do.insert(
@@ -176,13 +281,13 @@ class UNet(nn.Module):
                                 stride=stride,
                                 **kwargs,
                             ),
-                            nn.LayerNorm(),
+                            LayerNorm(),
                         ),
                     )
 
                     up.append(
                         nn.Sequential(
-                            nn.LayerNorm(),
+                            LayerNorm(),
                             nn.Resample(factor=stride, method='nearest'),
                         )
                     )
@@ -203,6 +308,11 @@ class UNet(nn.Module):
                 self.descent.append(do)
                 self.ascent.insert(0, up)
 
+    def __setstate__(self, state: Dict[str, Any]):
+        self.__dict__.update(state)
+        self.descent = list(map(restack, self.descent))
+        self.ascent = list(map(restack, self.ascent))
+
     def __call__(self, x: Array, t: Array, key: Array = None) -> Array:
         r"""
         Arguments:
@@ -211,32 +321,49 @@ class UNet(nn.Module):
             key: A PRNG key.
         """
 
+        if self.dtype is None:
+            return self.forward(x, t, key)
+
+        def cast(leaf: Any) -> Any:
+            if isinstance(leaf, Array) and jnp.issubdtype(leaf.dtype, jnp.floating):
+                return leaf.astype(self.dtype)
+            else:
+                return leaf
+
+        def keep(node: Any) -> bool:
+            return isinstance(node, nn.LayerNorm) or node is self.ascent[-1][-1]
+
+        # Parameters are stored in full precision but cast for the forward pass, except
+        # for the normalization layers and the output projection
+        net = jax.tree_util.tree_map(cast, self, is_leaf=keep)
+
+        return net.forward(cast(x), cast(t), key).astype(x.dtype)
+
+    def forward(self, x: Array, t: Array, key: Array = None) -> Array:
         if key is None:
             rng = None
         else:
             rng = PRNG(key)
 
         with set_rng(rng):
-            memory = []
+            memory = ()
 
             for blocks in self.descent:
                 for block in blocks:
-                    if isinstance(block, (ResBlock, AttBlock)):
-                        x = block(x, t)
+                    if isinstance(block, Stack):
+                        x = block(x, t, key=None if rng is None else rng.split())
                     else:
                         x = block(x)
 
-                memory.append(x)
-
-            for blocks in self.ascent:
-                y = memory.pop()
+                memory = (*memory, x)
 
+            for blocks, y in zip(self.ascent, reversed(memory)):
                 if x is not y:
                     x = jnp.concatenate((x, y), axis=-1)
 
                 for block in blocks:
-                    if isinstance(block, (ResBlock, AttBlock)):
-                        x = block(x, t)
+                    if isinstance(block, Stack):
+                        x = block(x, t, key=None if rng is None else rng.split())
                     else:
                         x = block(x)
 
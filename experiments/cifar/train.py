@@ -3,13 +3,13 @@
 import inox
 import inox.nn as nn
 import jax
-import numpy as np
 import optax
 import wandb
 
-from datasets import Array3D, Features, load_from_disk
+from datasets import load_from_disk
 from dawgz import job, schedule
 from functools import partial
+from jax.experimental.shard_map import shard_map
 from tqdm import trange
 from typing import *
 
@@ -26,6 +26,7 @@ CONFIG = {
     'emb_features': 256,
     'heads': {1: 4},
     'dropout': 0.1,
+    'dtype': None,
     # Sampling
     'sampler': 'ddpm',
     'sde': {'a': 1e-3, 'b': 1e2},
@@ -46,25 +47,26 @@ CONFIG = {
 }
 
 
-def generate(model, dataset, rng, batch_size, **kwargs):
-    def transform(batch):
-        y, A = batch['y'], batch['A']
-        x = sample(model, y, A, rng.split(), **kwargs)
-        x = np.asarray(x)
+def generate(model, dataset, rng, batch_size, sharding, **kwargs):
+    y, A = dataset['y'], dataset['A']
+    steps = len(y) // batch_size
 
-        return {'x': x}
+    @partial(jax.jit, out_shardings=sharding)
+    def allocate():
+        return jnp.zeros((steps, batch_size, 32, 32, 3))
 
-    types = {'x': Array3D(shape=(32, 32, 3), dtype='float32')}
+    @partial(jax.jit, donate_argnums=0)
+    def write(buffer, x, i):
+        return jax.lax.dynamic_update_slice_in_dim(buffer, x[None], i, axis=0)
 
-    return dataset.map(
-        transform,
-        features=Features(types),
-        remove_columns=['y', 'A'],
-        keep_in_memory=True,
-        batched=True,
-        batch_size=batch_size,
-        drop_last_batch=True,
-    )
+    buffer = allocate()
+
+    for i in range(steps):
+        batch = slice(i * batch_size, (i + 1) * batch_size)
+        x = sample(model, y[batch], A[batch], rng.split(), **kwargs)
+        buffer = write(buffer, x, i)
+
+    return buffer
 
 
 def train(runid: int, lap: int):
@@ -87,6 +89,7 @@ def train(runid: int, lap: int):
     mesh = jax.sharding.Mesh(jax.devices(), 'i')
     replicated = jax.sharding.NamedSharding(mesh, jax.sharding.PartitionSpec())
     distributed = jax.sharding.NamedSharding(mesh, jax.sharding.PartitionSpec('i'))
+    stacked = jax.sharding.NamedSharding(mesh, jax.sharding.PartitionSpec(None, 'i'))
 
     # RNG
     seed = hash((runpath, lap)) % 2**16
@@ -99,17 +102,17 @@ def train(runid: int, lap: int):
     dataset = load_from_disk(PATH / f'hf/cifar-mask-{config.corruption}')
     dataset.set_format('numpy')
 
-    trainset_yA = dataset['train']
-    testset_yA = dataset['test']
+    trainset_yA = dataset['train'][:]
+    testset_yA = dataset['test'][:]
 
-    y_eval, A_eval = testset_yA[:16]['y'], testset_yA[:16]['A']
+    y_eval, A_eval = testset_yA['y'][:16], testset_yA['A'][:16]
     y_eval, A_eval = jax.device_put((y_eval, A_eval), distributed)
 
     # Previous
     if lap > 0:
         previous = load_module(runpath / f'checkpoint_{lap - 1}.pkl')
     else:
-        y_fit, A_fit = trainset_yA[:16384]['y'], trainset_yA[:16384]['A']
+        y_fit, A_fit = trainset_yA['y'][:16384], trainset_yA['A'][:16384]
         y_fit, A_fit = jax.device_put((y_fit, A_fit), distributed)
 
         mu_x, cov_x = fit_moments(
@@ -132,7 +135,7 @@ def train(runid: int, lap: int):
 
     ## Generate
     static, arrays = previous.partition()
-    arrays = jax.device_put(arrays, replicated)
+    arrays = replicate(arrays)
     previous = static(arrays)
 
     trainset = generate(
@@ -140,6 +143,7 @@ def train(runid: int, lap: int):
         dataset=trainset_yA,
         rng=rng,
         batch_size=config.batch_size,
+        sharding=stacked,
         shard=True,
         sampler=config.sampler,
         sde=sde,
@@ -151,6 +155,7 @@ def train(runid: int, lap: int):
         dataset=testset_yA,
         rng=rng,
         batch_size=config.batch_size,
+        sharding=stacked,
         shard=True,
         sampler=config.sampler,
         sde=sde,
@@ -159,12 +164,8 @@ def train(runid: int, lap: int):
     )
 
     ## Moments
-    x_fit = trainset[:16384]['x']
-    x_fit = flatten(x_fit)
-
-    mu_x, cov_x = ppca(x_fit, rank=64, key=rng.split())
-
-    del x_fit
+    mu_x = jnp.mean(trainset, axis=(0, 1))
+    mu_x = flatten(mu_x)
 
     # Model
     if lap > 0:
@@ -181,29 +182,33 @@ def train(runid: int, lap: int):
     elif config.heuristic == 'cov_t':
         model.cov_x = jnp.ones_like(mu_x) * 1e6
     elif config.heuristic == 'cov_x':
-        model.cov_x = cov_x
+        x_fit = trainset.reshape(-1, 32, 32, 3)[:16384]
+        x_fit = flatten(x_fit)
+
+        _, model.cov_x = ppca(x_fit, rank=64, key=rng.split())
+
+        del x_fit
 
     model.train(True)
 
     static, params, others = model.partition(nn.Parameter)
+    params, others = replicate((params, others))
 
     # Objective
     objective = DenoiserLoss(sde=sde)
 
     # Optimizer
-    steps = config.epochs * len(trainset_yA) // config.batch_size
+    steps = config.epochs * len(trainset_yA['y']) // config.batch_size
     optimizer = Adam(steps=steps, **config)
     opt_state = optimizer.init(params)
 
     # EMA
     ema = EMA(decay=config.ema_decay)
-    avrg = params
+    avrg = jax.tree_util.tree_map(jnp.copy, params)
 
     # Training
-    avrg, params, others, opt_state = jax.device_put((avrg, params, others, opt_state), replicated)
+    avrg, opt_state = replicate((avrg, opt_state))
 
-    @jax.jit
-    @jax.vmap
     def augment(x, key):
         keys = jax.random.split(key, 3)
 
@@ -213,56 +218,86 @@ def train(runid: int, lap: int):
 
         return x
 
-    @jax.jit
-    def ell(params, others, x, key):
-        keys = jax.random.split(key, 3)
+    @partial(jax.jit, out_shardings=stacked)
+    def shuffle(x, key):
+        shape = x.shape
+
+        x = x.reshape(-1, *shape[2:])
+        x = jax.random.permutation(key, x)
+        x = x.reshape(shape)
 
-        z = jax.random.normal(keys[0], shape=x.shape)
-        t = jax.random.beta(keys[1], a=3, b=3, shape=x.shape[:1])
+        return x
 
-        return objective(static(params, others), x, z, t, key=keys[2])
+    @partial(jax.jit, static_argnums=(1, 2), out_shardings=stacked)
+    def noise(key, n_steps, shape):
+        keys = jax.random.split(key, 2)
+
+        z = jax.random.normal(keys[0], shape=(n_steps, *shape))
+        t = jax.random.beta(keys[1], a=3, b=3, shape=(n_steps, *shape[:1]))
+
+        return z, t
 
     @jax.jit
-    def sgd_step(avrg, params, others, opt_state, x, key):
-        loss, grads = jax.value_and_grad(ell)(params, others, x, key)
+    def ell(params, others, x, z, t, key):
+        return objective(static(params, others), x, z, t, key=key)
+
+    @partial(
+        shard_map,
+        mesh=mesh,
+        in_specs=(replicated.spec,) * 4 + (distributed.spec,) * 4,
+        out_specs=replicated.spec,
+    )
+    def step(avrg, params, others, opt_state, x, z, t, keys):
+        keys = jax.random.split(keys[0], len(x) + 1)
+
+        x = jax.vmap(augment)(x, keys[1:])
+        x = flatten(x)
+
+        # params are replicated, so the gradient of the mean loss is already averaged
+        loss, grads = jax.value_and_grad(
+            lambda params: jax.lax.pmean(ell(params, others, x, z, t, keys[0]), axis_name='i')
+        )(params)
         updates, opt_state = optimizer.update(grads, opt_state, params)
         params = optax.apply_updates(params, updates)
         avrg = ema(avrg, params)
 
         return loss, avrg, params, opt_state
 
-    for epoch in (bar := trange(config.epochs, ncols=88)):
-        loader = trainset.shuffle(seed=seed + lap * config.epochs + epoch).iter(
-            batch_size=config.batch_size, drop_last_batch=True
-        )
+    @partial(jax.jit, donate_argnums=(0, 1, 3, 4, 5, 6))
+    def train_epoch(avrg, params, others, opt_state, x, z, t, key):
+        def body(i, state):
+            loss_acc, avrg, params, opt_state = state
+            keys = jax.random.split(jax.random.fold_in(key, i), mesh.size)
+            loss, avrg, params, opt_state = step(avrg, params, others, opt_state, x[i], z[i], t[i], keys)
 
-        losses = []
+            return loss_acc + loss, avrg, params, opt_state
 
-        for batch in prefetch(loader):
-            x = batch['x']
-            x = jax.device_put(x, distributed)
-            x = augment(x, rng.split(len(x)))
-            x = flatten(x)
+        loss, avrg, params, opt_state = jax.lax.fori_loop(0, len(x), body, (jnp.zeros(()), avrg, params, opt_state))
+
+        return loss / len(x), avrg, params, opt_state
 
-            loss, avrg, params, opt_state = sgd_step(avrg, params, others, opt_state, x, key=rng.split())
-            losses.append(loss)
+    train_steps = len(trainset)
+    test_steps = len(testset)
+
+    for epoch in (bar := trange(config.epochs, ncols=88)):
+        x = shuffle(trainset, rng.split())
+        z, t = noise(rng.split(), train_steps, (config.batch_size, 32 * 32 * 3))
 
-        loss_train = np.stack(losses).mean()
+        loss_train, avrg, params, opt_state = train_epoch(avrg, params, others, opt_state, x, z, t, rng.split())
+        loss_train = float(loss_train)
 
         ## Validation
-        loader = testset.iter(batch_size=config.batch_size, drop_last_batch=True)
+        z, t = noise(rng.split(), test_steps, (config.batch_size, 32 * 32 * 3))
 
-        losses = []
+        loss_val = jnp.zeros(())
 
-        for batch in prefetch(loader):
-            x = batch['x']
-            x = jax.device_put(x, distributed)
+        for i in range(test_steps):
+            x = testset[i]
             x = flatten(x)
 
-            loss = ell(avrg, others, x, key=rng.split())
-            losses.append(loss)
+            loss_val = loss_val + ell(avrg, others, x, z[i], t[i], key=rng.split())
 
-        loss_val = np.stack(losses).mean()
+        loss_val = float(loss_val / test_steps)
 
         bar.set_postfix(loss=loss_train, loss_val=loss_val)
 
@@ -62,6 +62,9 @@ def make_model(
     emb_features: int = 256,
     heads: Dict[int, int] = {2: 1},
     dropout: float = None,
+    separable: bool = False,
+    dtype: str = None,
+    checkpoint_levels: Sequence[int] = (),
     **absorb,
 ) -> Denoiser:
     return Denoiser(
@@ -74,6 +77,9 @@ def make_model(
             emb_features=emb_features,
             heads=heads,
             dropout=dropout,
+            separable=separable,
+            dtype=dtype,
+            checkpoint_levels=checkpoint_levels,
             key=key,
         ),
         emb_features=emb_features,
@@ -26,12 +26,14 @@ CONFIG = {
     'emb_features': 256,
     'heads': {3: 4},
     'dropout': 0.1,
+    'dtype': None,
     # Sampling
     'sampler': 'ddpm',
     'heuristic': None,
     'sde': {'a': 1e-3, 'b': 1e2},
     'discrete': 64,
     'maxiter': 3,
+    'use_matmul_dft': False,
     # Training
     'epochs': 64,
     'batch_size': 256,
@@ -117,7 +119,7 @@ def train(runid: int, lap: int):
             features=320 * 320 * 1,
             rank=64,
             shard=True,
-            A=inox.Partial(measure, A_fit, shard=True),
+            A=inox.Partial(measure, A_fit, shard=True, use_matmul_dft=config.use_matmul_dft),
             y=flatten(y_fit),
             cov_y=1e-2**2,
             sampler='ddim',
@@ -146,6 +148,7 @@ def train(runid: int, lap: int):
         sde=sde,
         steps=config.discrete,
         maxiter=config.maxiter,
+        use_matmul_dft=config.use_matmul_dft,
     )
     testset = generate(
         model=previous,
@@ -157,6 +160,7 @@ def train(runid: int, lap: int):
         sde=sde,
         steps=config.discrete,
         maxiter=config.maxiter,
+        use_matmul_dft=config.use_matmul_dft,
     )
 
     ## Moments
@@ -281,6 +285,7 @@ def train(runid: int, lap: int):
                 sampler=config.sampler,
                 steps=config.discrete,
                 maxiter=config.maxiter,
+                use_matmul_dft=config.use_matmul_dft,
             )
             x = x.reshape(2, 2, 320, 320, 1)
 
@@ -3,6 +3,7 @@ r"""FastMRI experiment helpers"""
 import math
 import os
 
+from functools import cache
 from jax import Array
 from jax.experimental.shard_map import shard_map
 from pathlib import Path
@@ -33,7 +34,47 @@ def complex2real(x: Array) -> Array:
     return jnp.concatenate((x.real, x.imag), axis=-1)
 
 
-def fft2c(x: Array, norm: str = 'ortho') -> Array:
+@cache
+def dft_matrix(n: int, inverse: bool = False, norm: str = 'ortho') -> np.ndarray:
+    r"""Returns the matrix of the centered (inverse) discrete Fourier transform."""
+
+    I = np.fft.ifftshift(np.eye(n), axes=0)
+
+    if inverse:
+        F = np.fft.ifft(I, axis=0, norm=norm)
+    else:
+        F = np.fft.fft(I, axis=0, norm=norm)
+
+    F = np.fft.fftshift(F, axes=0)
+
+    return F.astype(np.complex64)
+
+
+def dft2c(x: Array, inverse: bool = False, norm: str = 'ortho') -> Array:
+    r"""Computes the centered 2-d (inverse) DFT as dense matrix products.
+
+    The complex products are decomposed into real ones, which map better onto
+    matrix-multiply hardware than FFT kernels for moderate sizes.
+    """
+
+    x_re, x_im = jnp.real(x), jnp.imag(x)
+
+    for F, subscripts in (
+        (dft_matrix(x.shape[-3], inverse, norm), 'ij,...jwc->...iwc'),
+        (dft_matrix(x.shape[-2], inverse, norm), 'ij,...hjc->...hic'),
+    ):
+        x_re, x_im = (
+            jnp.einsum(subscripts, F.real, x_re) - jnp.einsum(subscripts, F.imag, x_im),
+            jnp.einsum(subscripts, F.real, x_im) + jnp.einsum(subscripts, F.imag, x_re),
+        )
+
+    return jax.lax.complex(x_re, x_im)
+
+
+def fft2c(x: Array, norm: str = 'ortho', use_matmul_dft: bool = False) -> Array:
+    if use_matmul_dft:
+        return dft2c(x, norm=norm)
+
     return jnp.fft.fftshift(
         jnp.fft.fft2(
             jnp.fft.ifftshift(x, axes=(-3, -2)),
@@ -44,7 +85,10 @@ def fft2c(x: Array, norm: str = 'ortho') -> Array:
     )
 
 
-def ifft2c(k: Array, norm: str = 'ortho') -> Array:
+def ifft2c(k: Array, norm: str = 'ortho', use_matmul_dft: bool = False) -> Array:
+    if use_matmul_dft:
+        return dft2c(k, inverse=True, norm=norm)
+
     return jnp.fft.fftshift(
         jnp.fft.ifft2(
             jnp.fft.ifftshift(
@@ -68,20 +112,20 @@ def make_mask(r: int = 4, key: Array = None) -> Array:
 
     if key is None:
         A = np.random.uniform(size=(1, 320, 1))
-        A = jnp.asarray(A)
     else:
         A = jax.random.uniform(key, shape=(1, 320, 1))
+        A = np.asarray(A)
 
     A = A < 200 / (320 * r - 120)
-    A = A.at[:, 160 - math.ceil(60 / r) : 160 + math.ceil(60 / r)].set(True)
+    A[:, 160 - math.ceil(60 / r) : 160 + math.ceil(60 / r)] = True
 
-    return A
+    return jnp.asarray(A)
 
 
-def measure(A: Array, x: Array, shard: bool = False) -> Array:
+def measure(A: Array, x: Array, shard: bool = False, use_matmul_dft: bool = False) -> Array:
     def f(A: Array, x: Array) -> Array:
         x = unflatten(x, 320, 320)
-        y = fft2c(x)
+        y = fft2c(x, use_matmul_dft=use_matmul_dft)
         y = A * y
         y = complex2real(y)
         y = flatten(y)
@@ -108,6 +152,7 @@ def sample(
     A: Array,
     key: Array,
     shard: bool = False,
+    use_matmul_dft: bool = False,
     **kwargs,
 ) -> Array:
     if shard:
@@ -117,7 +162,7 @@ def sample(
         model=model,
         shape=(len(y), 320 * 320 * 1),
         shard=shard,
-        A=inox.Partial(measure, A, shard=shard),
+        A=inox.Partial(measure, A, shard=shard, use_matmul_dft=use_matmul_dft),
         y=flatten(y),
         cov_y=1e-2**2,
         key=key,
@@ -137,6 +182,9 @@ def make_model(
     emb_features: int = 256,
     heads: Dict[int, int] = {2: 1},
     dropout: float = None,
+    separable: bool = False,
+    dtype: str = None,
+    checkpoint_levels: Sequence[int] = (),
     **absorb,
 ) -> Denoiser:
     return Denoiser(
@@ -149,6 +197,9 @@ def make_model(
             emb_features=emb_features,
             heads=heads,
             dropout=dropout,
+            separable=separable,
+            dtype=dtype,
+            checkpoint_levels=checkpoint_levels,
             key=key,
         ),
         emb_features=emb_features,
@@ -158,9 +209,13 @@ def make_model(
 class FlatUNet(UNet):
     def __call__(self, x: Array, t: Array, key: Array = None) -> Array:
         x = unflatten(x, width=320, height=320)
-        x = rearrange(x, '... (H h) (W w) C -> ... H W (h w C)', h=4, w=4)
+        x = x.reshape(*x.shape[:-3], 80, 4, 80, 4, x.shape[-1])
+        x = x.swapaxes(-4, -3)
+        x = x.reshape(*x.shape[:-5], 80, 80, -1)
         x = super().__call__(x, t, key)
-        x = rearrange(x, '... H W (h w C) -> ... (H h) (W w) C', h=4, w=4)
+        x = x.reshape(*x.shape[:-3], 80, 80, 4, 4, -1)
+        x = x.swapaxes(-4, -3)
+        x = x.reshape(*x.shape[:-5], 320, 320, -1)
         x = flatten(x)
 
         return x